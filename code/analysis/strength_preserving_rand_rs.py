@@ -2,6 +2,7 @@ import bct
 import math
 import numpy as np
 from sklearn.utils import check_random_state
+from strength_preserving_rand_sa_flexE import _triu_idx
 
 def strength_preserving_rand_rs(A,
                                 rewiring_iter = 10, sort_freq = 1,
@@ -94,8 +95,14 @@ def strength_preserving_rand_rs(A,
 
     B = np.zeros((n, n))
     s = np.sum(A, axis = 1) #strengths of A
-    sortAvec = np.sort(A[np.triu(A, k=1) > 0]) #sorted weights vector
-    x, y = np.nonzero(np.triu(R, k=1)) #weights indices
+    #gathering upper triangle edge lists without
+    #building masked triangle matrices
+    iu = _triu_idx(n)
+    A_vals = A[iu]
+    sortAvec = np.sort(A_vals[A_vals > 0]) #sorted weights vector
+    R = np.asarray(R)
+    R_nz = R[iu] != 0
+    x, y = iu[0][R_nz], iu[1][R_nz] #weights indices
 
     E = np.outer(s, s) #expected weights matrix
 
@@ -187,7 +187,7 @@ def strength_preserving_rand_sa_dir(A, rewiring_iter = 10,
                rs.rand() < np.exp(-(energy_prime - energy)/temp)):
                 sb_in = sb_prime_in.copy()
                 sb_out = sb_prime_out.copy()
-                wts[[e1, e2]] = wts[[e2, e1]]
+                wts[e1], wts[e2] = wts[e2], wts[e1]
                 energy = energy_prime
                 if energy < energymin:
                     energymin = energy
@@ -137,9 +137,11 @@ def strength_preserving_rand_sa_energy_thresh(A, rewiring_iter = 10,
             #permutation acceptance criterion
             if (delta_energy < 0 or prob < np.e**(-(delta_energy)/temp)):
 
-                sb[[a, b]] -= wts_change
-                sb[[c, d]] += wts_change
-                wts[[e1, e2]] = wts[[e2, e1]]
+                sb[a] -= wts_change
+                sb[b] -= wts_change
+                sb[c] += wts_change
+                sb[d] += wts_change
+                wts[e1], wts[e2] = wts[e2], wts[e1]
 
                 energy = np.mean((sb - s)**2)
 
@@ -159,6 +161,6 @@ def strength_preserving_rand_sa_energy_thresh(A, rewiring_iter = 10,
 
     B = np.zeros((n, n))
     B[(u, v)] = wtsmin
-    B = B + B.T
+    B[(v, u)] = wtsmin
 
     return B, energymin
@@ -2,13 +2,307 @@ import bct
 import numpy as np
 from tqdm import tqdm
 from sklearn.utils import check_random_state
+from functools import lru_cache
+from joblib import Parallel, delayed
+from collections import namedtuple
 
-def strength_preserving_rand_sa_flexE(A, rewiring_iter = 10, 
+try:
+    from numba import njit
+    use_numba = True
+except ImportError:
+    use_numba = False
+
+@lru_cache(maxsize = 8)
+def _triu_idx(n):
+    """
+    Upper triangle indices of an (n, n) matrix, cached across calls
+    on networks of the same size. The arrays are read-only.
+    """
+    iu = np.triu_indices(n, k = 1)
+    for idx in iu:
+        idx.flags.writeable = False
+    return iu
+
+def _anneal_stage(endpoints, wts, diff, edges, thresholds,
+                  sse, energy, energymin, wtsmin, denom, root):
+    """
+    Runs one annealing stage minimizing a squared error energy
+
+    Parameters
+    ----------
+    endpoints : (M, 2) numpy.ndarray
+        Upper triangle indices of the edges, one row per edge
+    wts : (M,) numpy.ndarray
+        Edge weights. Permuted in place.
+    diff : (N,) numpy.ndarray
+        Deviations between the strength sequences of the randomized
+        and the original network. Updated in place.
+    edges : (niter, 2) numpy.ndarray
+        Indices of the pairs of edges proposed for permutation
+    thresholds : (niter,) numpy.ndarray
+        Metropolis acceptance thresholds -temp*log(U) on the energy change,
+        with U uniform random numbers
+    sse : float
+        Current sum of squared deviations
+    energy : float
+        Current energy
+    energymin : float
+        Minimum energy obtained so far
+    wtsmin : (M,) numpy.ndarray
+        Edge weights at minimum energy. Updated in place
+        when the chain leaves its best state and at the end of the stage.
+    denom : float
+        Normalization of the sum of squared deviations
+        (1 for 'sse', N for 'mse' and 'rmse')
+    root : bool
+        Whether the energy is the square root of the normalized sum
+        of squared deviations ('rmse')
+
+    Returns
+    -------
+    sse : float
+        Sum of squared deviations at the end of the stage
+    energy : float
+        Energy at the end of the stage
+    energymin : float
+        Minimum energy obtained so far
+    naccept : int
+        Number of accepted permutations
+    """
+    naccept = 0
+    best_dirty = False #whether wts holds an unsaved best state
+    for i in range(len(thresholds)):
+
+        #permutation
+        e1, e2 = edges[i, 0], edges[i, 1]
+        a, b = endpoints[e1, 0], endpoints[e1, 1]
+        c, d = endpoints[e2, 0], endpoints[e2, 1]
+        wts_change = wts[e1] - wts[e2]
+
+        #a node shared by both edges keeps its strength
+        if a == c or a == d or b == c or b == d:
+            nchange = 1
+        else:
+            nchange = 2
+        sse_prime = sse + (2 * wts_change *
+                           (nchange * wts_change -
+                            diff[a] - diff[b] + diff[c] + diff[d]))
+        if root:
+            energy_prime = np.sqrt(sse_prime/denom)
+        else:
+            energy_prime = sse_prime/denom
+
+        #permutation acceptance criterion
+        if energy_prime - energy < thresholds[i]:
+            #saving the best state before leaving it
+            if best_dirty and energy_prime >= energymin:
+                wtsmin[:] = wts
+                best_dirty = False
+            diff[a] -= wts_change
+            diff[b] -= wts_change
+            diff[c] += wts_change
+            diff[d] += wts_change
+            wts[e1], wts[e2] = wts[e2], wts[e1]
+            sse = sse_prime
+            energy = energy_prime
+            if energy < energymin:
+                energymin = energy
+                best_dirty = True
+            naccept = naccept + 1
+
+    if best_dirty:
+        wtsmin[:] = wts
+
+    return sse, energy, energymin, naccept
+
+if use_numba:
+    _anneal_stage = njit(cache = True, fastmath = True,
+                         nogil = True)(_anneal_stage)
+
+#predefined energy functions between two strength sequences
+def _sse(x, y):
+    return np.sum((x - y)**2)
+
+def _max(x, y):
+    return np.max(np.abs(x - y))
+
+def _mae(x, y):
+    return np.mean(np.abs(x - y))
+
+def _mse(x, y):
+    return np.mean((x - y)**2)
+
+def _rmse(x, y):
+    return np.sqrt(np.mean((x - y)**2))
+
+_energy_funcs = {'sse': _sse, 'max': _max, 'mae': _mae,
+                 'mse': _mse, 'rmse': _rmse}
+
+def _run_chain(seed, endpoints, wts, s, sb, nstage, niter, temp, frac,
+               energy_type, energy_func, verbose, progress = True):
+    """
+    Runs one simulated annealing chain permuting the edge weights
+
+    Returns the edge weights at minimum energy and the minimum energy.
+    See `strength_preserving_rand_sa_flexE` for a description
+    of the parameters. “progress” toggles the progress bar.
+    """
+
+    rs = check_random_state(seed)
+    #PCG64 generator for faster draws, seeded from the random state
+    gen = np.random.default_rng(rs.randint(np.iinfo(np.int32).max))
+
+    n = len(s)
+    m = len(wts)
+    wts = wts.copy()
+    sb = sb.copy()
+
+    #squared error energies are updated incrementally from the
+    #deviations of the four strengths affected by a permutation
+    incremental = (energy_func is None and
+                   energy_type in ['sse', 'mse', 'rmse'])
+
+    #binding the energy function once for the whole chain
+    if energy_func is None:
+        energy_func = _energy_funcs[energy_type]
+
+    energy = float(energy_func(s, sb))
+
+    energymin = energy
+    wtsmin = wts.copy()
+
+    if incremental:
+        diff = sb - s #strength sequence deviations
+        sse = np.sum(diff**2)
+        denom = 1.0 if energy_type == 'sse' else float(n)
+        root = energy_type == 'rmse'
+
+    if verbose:
+        print('\ninitial energy {:.5f}'.format(energy))
+
+    for istage in tqdm(range(nstage), desc = 'annealing progress',
+                       disable = not progress):
+
+        #drawing the random numbers of the whole stage at once
+        edges = gen.integers(m, size = (niter, 2))
+        #folding the Metropolis criterion U < exp(-dE/temp)
+        #into a single comparison dE < -temp*log(U)
+        thresholds = -temp*np.log(gen.random(niter))
+
+        if incremental:
+            sse, energy, energymin, naccept = _anneal_stage(
+                endpoints, wts, diff, edges, thresholds,
+                sse, energy, energymin, wtsmin, denom, root
+                )
+            #resynchronizing the accumulated energy once per stage
+            sse = np.sum(diff**2)
+            energy = np.sqrt(sse/denom) if root else sse/denom
+        else:
+            naccept = 0
+            best_dirty = False #whether wts holds an unsaved best state
+            for i in range(niter):
+
+                #permutation
+                e1, e2 = edges[i, 0], edges[i, 1]
+
+                a, b = endpoints[e1]
+                c, d = endpoints[e2]
+
+                #permuting strengths in place
+                wts_change = wts[e1] - wts[e2]
+                sb[a] -= wts_change
+                sb[b] -= wts_change
+                sb[c] += wts_change
+                sb[d] += wts_change
+
+                energy_prime = energy_func(sb, s)
+
+                #permutation acceptance criterion
+                if energy_prime - energy < thresholds[i]:
+                    #saving the best state before leaving it
+                    if best_dirty and energy_prime >= energymin:
+                        wtsmin = wts.copy()
+                        best_dirty = False
+                    wts[e1], wts[e2] = wts[e2], wts[e1]
+                    energy = energy_prime
+                    if energy < energymin:
+                        energymin = energy
+                        best_dirty = True
+                    naccept = naccept + 1
+                else:
+                    #reverting rejected permutation
+                    sb[a] += wts_change
+                    sb[b] += wts_change
+                    sb[c] -= wts_change
+                    sb[d] -= wts_change
+
+            if best_dirty:
+                wtsmin = wts.copy()
+
+        #temperature update
+        temp = temp*frac
+        if verbose:
+            print('\nstage {:d}, temp {:.5f}, best energy {:.5f}, '
+                  'frac of accepted moves {:.3f}'.format(istage, temp,
+                                                         energymin,
+                                                         naccept/niter))
+
+    #energy of the returned weights rather than the accumulated one
+    sbmin = (np.bincount(endpoints[:, 0], wtsmin, n) +
+             np.bincount(endpoints[:, 1], wtsmin, n))
+    energymin = float(energy_func(s, sbmin))
+
+    return wtsmin, energymin
+
+SAPrepared = namedtuple('SAPrepared', ['A', 'n', 's', 'connected'])
+
+def prepare_sa_flexE(A, connected = None):
+    """
+    Precomputes the setup of strength_preserving_rand_sa_flexE
+    that only depends on A, to be reused across many nulls
+
+    Parameters
+    ----------
+    A : (N, N) array-like
+        Undirected weighted adjacency matrix
+    connected: bool, optional
+        Whether to ensure connectedness of the randomized network.
+        By default, this is inferred from data.
+
+    Returns
+    -------
+    prepared : SAPrepared
+        Named tuple with fields A (the adjacency matrix as an array),
+        n (number of nodes), s (strengths of A) and connected
+
+    Notes
+    -------
+    Usage: prep = prepare_sa_flexE(A), then
+    strength_preserving_rand_sa_flexE(prepared = prep, seed = i)
+    for every null. The rewiring is seeded and still runs per call.
+    """
+
+    try:
+        A = np.asarray(A)
+    except TypeError as err:
+        msg = ('A must be array_like. Received: {}.'.format(type(A)))
+        raise TypeError(msg) from err
+
+    n = A.shape[0]
+    s = np.sum(A, axis = 1) #strengths of A
+
+    if connected is None:
+        connected = False if bct.number_of_components(A) > 1 else True
+
+    return SAPrepared(A, n, s, connected)
+
+def strength_preserving_rand_sa_flexE(A = None, rewiring_iter = 10, 
                                       nstage = 100, niter = 10000,
                                       temp = 1000, frac = 0.5,
                                       energy_type = 'sse', energy_func = None,
-                                      connected = None, verbose = False, 
-                                      seed = None):
+                                      connected = None, verbose = False,
+                                      seed = None, n_chains = 1,
+                                      prepared = None):
     """
     Degree- and strength-preserving randomization of
     undirected, weighted adjacency matrix A
@@ -16,8 +310,9 @@ def strength_preserving_rand_sa_flexE(A, rewiring_iter = 10,
     
     Parameters
     ----------
-    A : (N, N) array-like
-        Undirected weighted adjacency matrix
+    A : (N, N) array-like, optional
+        Undirected weighted adjacency matrix.
+        Can be omitted if “prepared” is given.
     rewiring_iter : int, optional
         Rewiring parameter. Default = 10.
         Each edge is rewired approximately rewiring_iter times.
@@ -52,6 +347,17 @@ def strength_preserving_rand_sa_flexE(A, rewiring_iter = 10,
         Default = False.
     seed: float, optional
         Random seed. Default = None.
+    n_chains: int, optional
+        Number of independent annealing chains run in parallel
+        from the same rewired network. The chain reaching the lowest
+        energy is returned. Chains run in threads when the energy
+        is annealed by the compiled kernel and in separate processes
+        otherwise. Chains show no progress bar, and “verbose” only
+        reports the best chain. Default = 1.
+    prepared: SAPrepared, optional
+        Output of prepare_sa_flexE(A), skipping the setup that only
+        depends on A. Cannot be combined with “A”, and overwrites
+        “connected”. Default = None.
 
     Returns
     -------
@@ -78,24 +384,32 @@ def strength_preserving_rand_sa_flexE(A, rewiring_iter = 10,
     on the Human Connectome. Neuron.
     """
 
-    try:
-        A = np.asarray(A)
-    except TypeError as err:
-        msg = ('A must be array_like. Received: {}.'.format(type(A)))
-        raise TypeError(msg) from err
-    
+    if prepared is None:
+        if A is None:
+            msg = ('Either A or prepared must be given.')
+            raise ValueError(msg)
+        prepared = prepare_sa_flexE(A, connected = connected)
+    elif A is not None:
+        msg = ('A and prepared cannot both be given.')
+        raise ValueError(msg)
+    A, n, s, connected = prepared
+
     if frac > 1 or frac <= 0:
         msg = ('frac must be between 0 and 1. '
                'Received: {}.'.format(frac))
         raise ValueError(msg)
 
-    rs = check_random_state(seed)
+    if energy_func is None and energy_type not in _energy_funcs:
+        msg = ("energy_type must be one of 'sse', 'max', "
+               "'mae', 'mse', or 'rmse'. Received: {}.".format(energy_type))
+        raise ValueError(msg)
 
-    n = A.shape[0]
-    s = np.sum(A, axis = 1) #strengths of A
+    if not isinstance(n_chains, (int, np.integer)) or n_chains < 1:
+        msg = ('n_chains must be a positive integer. '
+               'Received: {}.'.format(n_chains))
+        raise ValueError(msg)
 
-    if connected is None:
-        connected = False if bct.number_of_components(A) > 1 else True
+    rs = check_random_state(seed)
 
     #Maslov & Sneppen rewiring
     if connected:
@@ -103,89 +417,45 @@ def strength_preserving_rand_sa_flexE(A, rewiring_iter = 10,
     else:
         B = bct.randmio_und(A, rewiring_iter, seed = seed)[0]
 
-    u, v = np.triu(B, k = 1).nonzero() #upper triangle indices
-    wts = np.triu(B, k = 1)[(u, v)] #upper triangle values
-    m = len(wts)
+    #extracting upper triangle edges in a single pass
+    iu = _triu_idx(n)
+    triu_vals = B[iu]
+    nz = triu_vals != 0
+    u, v = iu[0][nz], iu[1][nz] #upper triangle indices
+    wts = triu_vals[nz] #upper triangle values
     sb = np.sum(B, axis = 1) #strengths of B
 
-    if energy_func is not None:
-        energy = energy_func(s, sb)
-    elif energy_type == 'sse':
-        energy = np.sum((s - sb)**2)
-    elif energy_type == 'max':
-        energy = np.max(np.abs(s - sb))
-    elif energy_type == 'mae':
-        energy = np.mean(np.abs(s - sb))
-    elif energy_type == 'mse':
-        energy = np.mean((s - sb)**2)
-    elif energy_type == 'rmse':
-        energy = np.sqrt(np.mean((s - sb)**2))
-    else:
-        msg = ("energy_type must be one of 'sse', 'max', "
-               "'mae', 'mse', or 'rmse'. Received: {}.".format(energy_type))
-        raise ValueError(msg)
-
-    energymin = energy
-    wtsmin = wts.copy()
-
-    if verbose:
-        print('\ninitial energy {:.5f}'.format(energy))
+    #both endpoints of an edge stored contiguously
+    endpoints = np.stack([u, v], axis = 1).astype(np.int32)
 
-    for istage in tqdm(range(nstage), desc = 'annealing progress'):
-
-        naccept = 0
-        for i in range(niter):
-
-            #permutation
-            e1 = rs.randint(m)
-            e2 = rs.randint(m)
-
-            a, b = u[e1], v[e1]
-            c, d = u[e2], v[e2]
-
-            sb_prime = sb.copy()
-            sb_prime[[a, b]] = sb_prime[[a, b]] - wts[e1] + wts[e2]
-            sb_prime[[c, d]] = sb_prime[[c, d]] + wts[e1] - wts[e2]
-
-            if energy_func is not None:
-                energy_prime = energy_func(sb_prime, s)
-            elif energy_type == 'sse':
-                energy_prime = np.sum((sb_prime - s)**2)
-            elif energy_type == 'max':
-                energy_prime = np.max(np.abs(sb_prime - s))
-            elif energy_type == 'mae':
-                energy_prime = np.mean(np.abs(sb_prime - s))
-            elif energy_type == 'mse':
-                energy_prime = np.mean((sb_prime - s)**2)
-            elif energy_type == 'rmse':
-                energy_prime = np.sqrt(np.mean((sb_prime - s)**2))
-            else:
-                msg = ("energy_type must be one of 'sse', 'max', "
-                       "'mae', 'mse', or 'rmse'. "
-                       "Received: {}.".format(energy_type))
-                raise ValueError(msg)
-
-            #permutation acceptance criterion
-            if (energy_prime < energy or
-               rs.rand() < np.exp(-(energy_prime - energy)/temp)):
-                sb = sb_prime.copy()
-                wts[[e1, e2]] = wts[[e2, e1]]
-                energy = energy_prime
-                if energy < energymin:
-                    energymin = energy
-                    wtsmin = wts.copy()
-                naccept = naccept + 1
-
-        #temperature update
-        temp = temp*frac
+    if n_chains == 1:
+        wtsmin, energymin = _run_chain(rs, endpoints, wts, s, sb,
+                                       nstage, niter, temp, frac,
+                                       energy_type, energy_func, verbose)
+    else:
+        #independent chains seeded from the main random state
+        chain_seeds = rs.randint(np.iinfo(np.int32).max, size = n_chains)
+        #the compiled kernel releases the GIL, so chains can share
+        #one process; the Python annealing loop needs separate processes
+        nogil = (use_numba and energy_func is None and
+                 energy_type in ['sse', 'mse', 'rmse'])
+        prefer = 'threads' if nogil else 'processes'
+        #chains run silently, only the best one is reported
+        chains = Parallel(n_jobs = n_chains, prefer = prefer)(
+            delayed(_run_chain)(chain_seed, endpoints, wts, s, sb,
+                                nstage, niter, temp, frac,
+                                energy_type, energy_func, False,
+                                progress = False)
+            for chain_seed in chain_seeds
+            )
+        best = min(range(n_chains), key = lambda i: chains[i][1])
+        wtsmin, energymin = chains[best]
         if verbose:
-            print('\nstage {:d}, temp {:.5f}, best energy {:.5f}, '
-                  'frac of accepted moves {:.3f}'.format(istage, temp,
-                                                         energymin,
-                                                         naccept/niter))
+            print('\nbest of {:d} chains: chain {:d}, '
+                  'best energy {:.5f}'.format(n_chains, best, energymin))
 
     B = np.zeros((n, n))
     B[(u, v)] = wtsmin
-    B = B + B.T
+    B[(v, u)] = wtsmin
 
     return B, energymin
\ No newline at end of file
@@ -3,12 +3,104 @@ import numpy as np
 from tqdm import tqdm
 from sklearn.utils import check_random_state
 from utils import cpl_func
+from strength_preserving_rand_sa_flexE import _triu_idx
+
+try:
+    from numba import njit
+    use_numba = True
+except ImportError:
+    use_numba = False
+
+def _anneal_stage(endpoints, wts, diff, edges, thresholds,
+                  sse, energymin, wtsmin):
+    """
+    Runs one annealing stage minimizing the mean squared error
+    between strength sequences
+
+    Parameters
+    ----------
+    endpoints : (M, 2) numpy.ndarray
+        Upper triangle indices of the edges, one row per edge
+    wts : (M,) numpy.ndarray
+        Edge weights. Permuted in place.
+    diff : (N,) numpy.ndarray
+        Deviations between the strength sequences of the randomized
+        and the original network. Updated in place.
+    edges : (niter, 2) numpy.ndarray
+        Indices of the pairs of edges proposed for permutation
+    thresholds : (niter,) numpy.ndarray
+        Metropolis acceptance thresholds -temp*log(U) on the energy change,
+        with U uniform random numbers
+    sse : float
+        Current sum of squared deviations
+    energymin : float
+        Minimum energy obtained so far
+    wtsmin : (M,) numpy.ndarray
+        Edge weights at minimum energy. Updated in place
+        when the chain leaves its best state and at the end of the stage.
+
+    Returns
+    -------
+    sse : float
+        Sum of squared deviations at the end of the stage
+    energymin : float
+        Minimum energy obtained so far
+    naccept : int
+        Number of accepted permutations
+    """
+    n = len(diff)
+    naccept = 0
+    best_dirty = False #whether wts holds an unsaved best state
+    for i in range(len(thresholds)):
+
+        #permutation
+        e1, e2 = edges[i, 0], edges[i, 1]
+        a, b = endpoints[e1, 0], endpoints[e1, 1]
+        c, d = endpoints[e2, 0], endpoints[e2, 1]
+        wts_change = wts[e1] - wts[e2]
+        delta_energy = (2 * wts_change *
+                        (2 * wts_change -
+                         diff[a] - diff[b] + diff[c] + diff[d]))
+
+        #permutation acceptance criterion
+        if delta_energy < thresholds[i]:
+            #exact change of the tracked energy,
+            #as a node shared by both edges keeps its strength
+            if a == c or a == d or b == c or b == d:
+                sse = sse + delta_energy - 2 * wts_change**2
+            else:
+                sse = sse + delta_energy
+            energy = sse/n
+
+            #saving the best state before leaving it
+            if best_dirty and energy >= energymin:
+                wtsmin[:] = wts
+                best_dirty = False
+
+            diff[a] -= wts_change
+            diff[b] -= wts_change
+            diff[c] += wts_change
+            diff[d] += wts_change
+            wts[e1], wts[e2] = wts[e2], wts[e1]
+
+            if energy < energymin:
+                energymin = energy
+                best_dirty = True
+            naccept = naccept + 1
+
+    if best_dirty:
+        wtsmin[:] = wts
+
+    return sse, energymin, naccept
+
+if use_numba:
+    _anneal_stage = njit(cache = True, fastmath = True)(_anneal_stage)
 
 def strength_preserving_rand_sa_trajectory(A, rewiring_iter = 10,
                                            nstage = 100, niter = 10000,
                                            temp = 1000, frac = 0.5,
-                                           connected = None, verbose = False, 
-                                           seed = None):
+                                           connected = None, verbose = False,
+                                           seed = None, metric_stride = 1):
 
     """
     Degree- and strength-preserving randomization of
@@ -38,6 +130,10 @@ def strength_preserving_rand_sa_trajectory(A, rewiring_iter = 10,
         Default = False.
     seed: float, optional
         Random seed. Default = None.
+    metric_stride: int, optional
+        Number of stages between recordings of the energy
+        and global network features. The last stage is always recorded.
+        Default = 1.
 
     Returns
     -------
@@ -75,7 +171,14 @@ def strength_preserving_rand_sa_trajectory(A, rewiring_iter = 10,
                'Received: {}.'.format(frac))
         raise ValueError(msg)
 
+    if metric_stride < 1:
+        msg = ('metric_stride must be a positive integer. '
+               'Received: {}.'.format(metric_stride))
+        raise ValueError(msg)
+
     rs = check_random_state(seed)
+    #PCG64 generator for faster draws, seeded from the random state
+    gen = np.random.default_rng(rs.randint(np.iinfo(np.int32).max))
 
     n = A.shape[0]
     s = np.sum(A, axis = 1) #strengths of A
@@ -89,12 +192,20 @@ def strength_preserving_rand_sa_trajectory(A, rewiring_iter = 10,
     else:
         B = bct.randmio_und(A, rewiring_iter, seed = seed)[0]
 
-    u, v = np.triu(B, k = 1).nonzero() #upper triangle indices
-    wts = np.triu(B, k = 1)[(u, v)] #upper triangle values
+    #extracting upper triangle edges in a single pass
+    iu = _triu_idx(n)
+    triu_vals = B[iu]
+    nz = triu_vals != 0
+    u, v = iu[0][nz], iu[1][nz] #upper triangle indices
+    wts = triu_vals[nz] #upper triangle values
+    #both endpoints of an edge stored contiguously
+    endpoints = np.stack([u, v], axis = 1).astype(np.int32)
     m = len(wts)
     sb = np.sum(B, axis = 1) #strengths of B
 
-    energy = np.mean((s - sb)**2)
+    diff = sb - s #strength sequence deviations
+    sse = np.sum(diff**2)
+    energy = sse/n
 
     energymin = energy
     wtsmin = wts.copy()
@@ -103,43 +214,22 @@ def strength_preserving_rand_sa_trajectory(A, rewiring_iter = 10,
         print('\ninitial energy {:.5f}'.format(energy))
 
     #tracking energy, and global network features
-    #at each stage
+    #every metric_stride stages
     strengths_trajectory = []
     energy_trajectory = []
     cpl_trajectory = []
     clustering_trajectory = []
 
+    curr_B = np.zeros((n, n)) #reused at every recorded stage
+
     for istage in tqdm(range(nstage), desc='annealing progress'):
-        naccept = 0
-        for (e1, e2), prob in zip(rs.randint(m, size=(niter, 2)),
-                                  rs.rand(niter)
-                                  ):
-
-            #permutation
-            a, b, c, d = u[e1], v[e1], u[e2], v[e2]
-            wts_change = wts[e1] - wts[e2]
-            delta_energy = (2 * wts_change *
-                            (2 * wts_change +
-                             (s[a] - sb[a]) +
-                             (s[b] - sb[b]) -
-                             (s[c] - sb[c]) -
-                             (s[d] - sb[d])
-                             )
-                            )
-
-            #permutation acceptance criterion
-            if (delta_energy < 0 or prob < np.e**(-(delta_energy)/temp)):
-
-                sb[[a, b]] -= wts_change
-                sb[[c, d]] += wts_change
-                wts[[e1, e2]] = wts[[e2, e1]]
-
-                energy = np.mean((sb - s)**2)
-
-                if energy < energymin:
-                    energymin = energy
-                    wtsmin = wts.copy()
-                naccept = naccept + 1
+        edges = gen.integers(m, size=(niter, 2))
+        #folding the Metropolis criterion U < exp(-dE/temp)
+        #into a single comparison dE < -temp*log(U)
+        thresholds = -temp*np.log(gen.random(niter))
+        sse, energymin, naccept = _anneal_stage(endpoints, wts, diff,
+                                                edges, thresholds,
+                                                sse, energymin, wtsmin)
 
         #temperature update
         temp = temp*frac
@@ -148,17 +238,22 @@ def strength_preserving_rand_sa_trajectory(A, rewiring_iter = 10,
                   'frac of accepted moves {:.3f}'.format(istage, temp,
                                                          energymin,
                                                          naccept/niter))
-        
-        curr_B = np.zeros((n, n))
+
+        if (istage + 1) % metric_stride and istage != nstage - 1:
+            continue
+
+        #the edge set is fixed, so overwriting it clears the previous stage
         curr_B[(u, v)] = wtsmin
-        curr_B = curr_B + curr_B.T
+        curr_B[(v, u)] = wtsmin
         cpl = cpl_func(curr_B)
         #weight conversion between 0 and 1 to compute clustering coefficient
         conv_B = bct.weight_conversion(curr_B, 'normalize')
         clustering = bct.clustering_coef_wu(conv_B)
         mean_clustering = np.mean(clustering)
 
-        strengths_trajectory.append(np.sum(curr_B, axis = 1))
+        #strengths summed over the edge list rather than the dense matrix
+        strengths_trajectory.append(np.bincount(u, wtsmin, n) +
+                                    np.bincount(v, wtsmin, n))
         energy_trajectory.append(energymin)
         cpl_trajectory.append(cpl)
         clustering_trajectory.append(mean_clustering)